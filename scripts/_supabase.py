@@ -0,0 +1,87 @@
+## scripts/*.py가 공유하는 Supabase REST 클라이언트 / 재시도 / stock_prices 설정 ##
+
+import os
+import sys
+import time
+import functools
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import httpx
+
+
+# 최대 재시도 횟수 (Supabase 429/5xx 응답, Supabase 연결 실패, Yahoo 개별 fallback에 공통 적용)
+MAX_RETRIES = 3
+# 재시도 간 초기 딜레이 (초, 지수 백오프: 5 → 10 → 20)
+INITIAL_RETRY_DELAY = 5
+# Retry-After 헤더를 따르더라도 한 번에 기다리는 최대 시간 (초)
+MAX_RETRY_AFTER = 60
+# Supabase가 일시적인 오류로 돌려주는 상태 코드 (이 경우 재시도)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Supabase REST 호출은 모두 이 클라이언트를 재사용
+# (HTTP/2 멀티플렉싱 + keep-alive로 TCP/TLS 핸드셰이크 절감)
+# NOTE: yfinance는 자체 세션(curl_cffi)을 쓰므로 여기 클라이언트를 넘기지 않는다.
+CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=8),
+        # 연결 실패(ConnectError/ConnectTimeout)만 transport 안에서 재시도
+        # (429/5xx 응답 재시도는 request_with_retry에서 처리)
+        retries=MAX_RETRIES,
+    ),
+    timeout=30.0,
+)
+
+
+def request_with_retry(method: str, url: str, **kwargs: Any) -> httpx.Response:
+    """Supabase 요청이 429/5xx로 실패하면 Retry-After(없으면 지수 백오프)만큼 기다렸다가 재시도"""
+    for retry_count in range(MAX_RETRIES):
+        resp = CLIENT.request(method, url, **kwargs)
+        if resp.status_code not in RETRYABLE_STATUS_CODES:
+            return resp
+
+        retry_after = resp.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = min(int(retry_after), MAX_RETRY_AFTER)
+        else:
+            delay = INITIAL_RETRY_DELAY * (2 ** retry_count)
+        print(f"Supabase {method} returned {resp.status_code}. Retrying after {delay} seconds... (attempt {retry_count + 1}/{MAX_RETRIES})")
+        time.sleep(delay)
+
+    return CLIENT.request(method, url, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def stock_prices_config() -> Tuple[str, Dict[str, str], Dict[str, str]]:
+    """stock_prices 엔드포인트와 upsert/delete 헤더를 처음 호출 시 한 번만 만들어 재사용"""
+    supabase_url = os.environ.get("SUPABASE_URL")
+    service_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+
+    if not supabase_url or not service_key:
+        error_msg = "Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY in environment\n"
+        error_msg += "\n로컬 테스트 방법:\n"
+        error_msg += "1. PowerShell에서:\n"
+        error_msg += "   $env:SUPABASE_URL='your-url'\n"
+        error_msg += "   $env:SUPABASE_SERVICE_ROLE_KEY='your-key'\n"
+        error_msg += f"   python scripts/{Path(sys.argv[0]).name}\n"
+        error_msg += "\n2. 또는 .env 파일에 추가:\n"
+        error_msg += "   SUPABASE_URL=your-url\n"
+        error_msg += "   SUPABASE_SERVICE_ROLE_KEY=your-key\n"
+        error_msg += "\n그리고: pip install python-dotenv\n"
+        raise RuntimeError(error_msg)
+
+    endpoint = f"{supabase_url.rstrip('/')}/rest/v1/stock_prices"
+    upsert_headers = {
+        "apikey": service_key,
+        "Authorization": f"Bearer {service_key}",
+        "Content-Type": "application/json",
+        "Prefer": "resolution=merge-duplicates,return=minimal",
+    }
+    delete_headers = {
+        "apikey": service_key,
+        "Authorization": f"Bearer {service_key}",
+        # 삭제된 행은 돌려받지 않고, 개수만 Content-Range 헤더로 받는다.
+        "Prefer": "return=minimal,count=exact",
+    }
+    return endpoint, upsert_headers, delete_headers
@@ -1,13 +1,13 @@
 ## 모든 supabase 240일 데이터 소실시 채우는 .py####
 
-import os
 import datetime as dt
-import json
 from pathlib import Path
 from typing import List, Dict, Any
 
 import yfinance as yf
-import requests
+import orjson
+
+from _supabase import request_with_retry, stock_prices_config
 
 # .env 파일 자동 로드 (python-dotenv가 있으면)
 try:
@@ -52,69 +52,80 @@ TICKERS: List[str] = [
     "BMNR",
 ]
 
+# yf.download 내부 동시 요청 수 (Yahoo 429 방지를 위해 8개로 제한)
+MAX_DOWNLOAD_THREADS = 8
+# Supabase upsert 1회당 최대 행 수
+# (period="240d"는 달력 기준이라 약 165거래일 × 26개 티커 ≈ 4,300행을 나눠서 전송)
+UPSERT_BATCH_SIZE = 500
+
 
-def fetch_history_for_ticker(ticker_symbol: str, days: int = 240) -> List[Dict[str, Any]]:
+def fetch_history_for_all(tickers: List[str], days: int = 240) -> List[Dict[str, Any]]:
     """
-    단일 종목의 과거 N일치 종가 데이터를 yfinance에서 가져와
+    모든 종목의 과거 N일치 종가 데이터를 yf.download 한 번으로 가져와
     Supabase stock_prices 테이블 형식으로 변환합니다.
+    한 번의 백필로 만든 모든 행은 같은 fetched_at(백필 실행 시각)을 공유합니다.
     """
-    print(f"Fetching history for {ticker_symbol} ({days} days)...")
-    ticker = yf.Ticker(ticker_symbol)
-    hist = ticker.history(period=f"{days}d", interval="1d")
+    print(f"Fetching history for {len(tickers)} tickers ({days} days)...")
+    df = yf.download(
+        tickers,
+        period=f"{days}d",
+        interval="1d",
+        group_by="ticker",
+        threads=MAX_DOWNLOAD_THREADS,
+        auto_adjust=True,
+        progress=False,
+    )
 
-    if hist.empty:
-        print(f"⚠ Warning: No history found for {ticker_symbol}")
+    if df.empty:
+        print("⚠ Warning: No history returned from yfinance")
         return []
 
+    fetched_at = dt.datetime.now(dt.timezone.utc).isoformat().replace("+00:00", "Z")
+    downloaded = set(df.columns.get_level_values(0))
+
     rows: List[Dict[str, Any]] = []
-    for idx, row in hist.iterrows():
-        trade_date = idx.date().isoformat()  # YYYY-MM-DD
-        close = float(row["Close"])
-        fetched_at = dt.datetime.now(dt.timezone.utc).isoformat().replace("+00:00", "Z")
-
-        rows.append(
-            {
-                "symbol": ticker_symbol,
-                "trade_date": trade_date,
-                "close": close,
-                "fetched_at": fetched_at,
-            }
+    for ticker_symbol in tickers:
+        if ticker_symbol not in downloaded:
+            print(f"⚠ Warning: No history found for {ticker_symbol}")
+            continue
+
+        closes = df[ticker_symbol]["Close"].dropna()
+        if closes.empty:
+            print(f"⚠ Warning: No history found for {ticker_symbol}")
+            continue
+
+        frame = closes.rename("close").to_frame()
+        frame["symbol"] = ticker_symbol
+        frame["trade_date"] = closes.index.strftime("%Y-%m-%d")  # YYYY-MM-DD
+        frame["fetched_at"] = fetched_at
+        rows.extend(
+            frame[["symbol", "trade_date", "close", "fetched_at"]].to_dict(orient="records")
         )
 
-    print(f"  -> Prepared {len(rows)} rows for {ticker_symbol}")
+        print(f"  -> Prepared {len(closes)} rows for {ticker_symbol}")
+
     return rows
 
 
 def upsert_to_supabase(rows: List[Dict[str, Any]]) -> None:
-    supabase_url = os.environ.get("SUPABASE_URL")
-    service_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-
-    if not supabase_url or not service_key:
-        error_msg = "Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY in environment\n"
-        error_msg += "\n예시:\n"
-        error_msg += "  $env:SUPABASE_URL='your-url'\n"
-        error_msg += "  $env:SUPABASE_SERVICE_ROLE_KEY='your-key'\n"
-        error_msg += "  python scripts/backfill_all_history.py\n"
-        raise RuntimeError(error_msg)
-
-    endpoint = f"{supabase_url.rstrip('/')}/rest/v1/stock_prices"
+    endpoint, headers, _ = stock_prices_config()
     params = {
         "on_conflict": "symbol,trade_date",
     }
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Content-Type": "application/json",
-        "Prefer": "resolution=merge-duplicates",
-    }
 
-    # rows가 많을 수 있으므로 필요시 나눠서 보낼 수 있지만,
-    # 13개 티커 × 240일 ≈ 3,120행 정도라 한 번에 보내도 무난함.
-    resp = requests.post(
-        endpoint, params=params, headers=headers, data=json.dumps(rows), timeout=60
-    )
-    if resp.status_code >= 300:
-        raise RuntimeError(f"Supabase upsert failed: {resp.status_code} {resp.text}")
+    # 한 번에 모두 보내면 요청이 커져 타임아웃 위험이 있으므로
+    # UPSERT_BATCH_SIZE 단위로 나눠서 같은 연결로 순차 전송.
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        chunk = rows[start:start + UPSERT_BATCH_SIZE]
+        resp = request_with_retry(
+            "POST", endpoint, params=params, headers=headers, content=orjson.dumps(chunk), timeout=60
+        )
+        if resp.status_code >= 300:
+            raise RuntimeError(
+                f"Supabase upsert failed at rows {start}-{start + len(chunk) - 1}: "
+                f"{resp.status_code} {resp.text}"
+            )
+        print(f"  -> Upserted rows {start + 1}-{start + len(chunk)} / {len(rows)}")
 
 
 def main() -> None:
@@ -130,14 +141,7 @@ def main() -> None:
     #
     # 여기서는 기존 데이터가 있으면 덮어쓰고, 없으면 새로 삽입.
 
-    all_rows: List[Dict[str, Any]] = []
-
-    for ticker in TICKERS:
-        try:
-            rows = fetch_history_for_ticker(ticker, 240)
-            all_rows.extend(rows)
-        except Exception as e:
-            print(f"✗ Error fetching history for {ticker}: {e}")
+    all_rows = fetch_history_for_all(TICKERS, 240)
 
     if not all_rows:
         print("⚠ No rows prepared. Exiting.")
@@ -1,13 +1,14 @@
-import os
+import sys
 import datetime as dt
-import json
 import time
-import random
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional
 from pathlib import Path
 
 import yfinance as yf
-import requests
+import orjson
+
+from _supabase import MAX_RETRIES, INITIAL_RETRY_DELAY, request_with_retry, stock_prices_config
 
 # .env 파일 자동 로드 (python-dotenv가 있으면)
 try:
@@ -31,104 +32,83 @@ TICKERS: List[str] = [
     "TSLA", "TSLL", "NVDA", "NVDL", "GOOGL", "GGLL", "PLTR", "PTIR", "COIN", "CONL", "MSTR", "MSTX", "BMNR",
 ]
 
-# 배치 크기 (2~3개씩 랜덤하게 묶어서 처리)
-MIN_BATCH_SIZE = 2
-MAX_BATCH_SIZE = 3
-# 배치 사이 딜레이 (랜덤 2.5~3.5초)
-MIN_DELAY = 2.5
-MAX_DELAY = 3.5
-# 최대 재시도 횟수
-MAX_RETRIES = 3
-# 재시도 간 초기 딜레이 (초)
-INITIAL_RETRY_DELAY = 5
+# yf.download 내부 동시 요청 수 (Yahoo 429 방지를 위해 8개로 제한)
+MAX_DOWNLOAD_THREADS = 8
 
 
-def fetch_ticker_price(ticker_symbol: str, retry_count: int = 0) -> Optional[Dict[str, Any]]:
-    """yfinance를 사용하여 단일 종목의 종가 가져오기 (재시도 로직 포함)"""
-    try:
-        ticker = yf.Ticker(ticker_symbol)
-        
-        # 최근 5거래일 내 데이터 가져오기
-        # 주말/공휴일에도 마지막 거래일(예: 금요일) 데이터가 반환되므로
-        # trade_date를 "실제 거래일"로 잡아서 주말/공휴일 중복 저장을 방지한다.
-        hist = ticker.history(period="5d", interval="1d")
-        
-        if hist.empty:
-            # 데이터가 없으면 info에서 이전 종가/시장 시간 가져오기 (최후의 수단)
-            info = ticker.info
-            close = info.get("regularMarketPrice") or info.get("previousClose")
-            if close is None:
+def fetch_ticker_price(ticker_symbol: str) -> Optional[Dict[str, Any]]:
+    """일괄 다운로드에서 빠진 종목 하나를 history()로 다시 가져오기 (재시도 로직 포함)"""
+    # Ticker 객체는 한 번만 만들고, 재시도 시에는 HTTP 요청만 다시 보낸다.
+    ticker = yf.Ticker(ticker_symbol)
+
+    for retry_count in range(MAX_RETRIES + 1):
+        try:
+            hist = ticker.history(period="5d", interval="1d")
+
+            closes = hist["Close"].dropna() if not hist.empty else None
+            if closes is None or closes.empty:
                 print(f"⚠ Warning: No data found for {ticker_symbol}")
                 return None
-            market_time = info.get("regularMarketTime") or info.get("postMarketTime") or info.get("preMarketTime")
-            if not market_time:
-                print(f"⚠ Warning: No market time found for {ticker_symbol} (skip)")
-                return None
-            trade_date = dt.datetime.fromtimestamp(int(market_time), tz=dt.timezone.utc).date().isoformat()
-        else:
-            # 가장 최근 종가 가져오기
-            close = float(hist["Close"].iloc[-1])
-            # 가장 최근(=마지막 거래일) 날짜를 trade_date로 사용
-            trade_date = hist.index[-1].date().isoformat()
-        
-        return {
-            "symbol": ticker_symbol,
-            "close": close,
-            "trade_date": trade_date,
-        }
-    
-    except Exception as e:
-        if retry_count < MAX_RETRIES:
-            delay = INITIAL_RETRY_DELAY * (2 ** retry_count)  # Exponential backoff
-            print(f"Error fetching {ticker_symbol}: {e}. Retrying after {delay} seconds... (attempt {retry_count + 1}/{MAX_RETRIES})")
-            time.sleep(delay)
-            return fetch_ticker_price(ticker_symbol, retry_count + 1)
-        else:
-            print(f"✗ Failed to fetch {ticker_symbol} after {MAX_RETRIES} retries: {e}")
-            return None
-
-
-def fetch_quotes_batch(tickers: List[str]) -> List[Dict[str, Any]]:
-    """한 배치의 종목들을 순차적으로 가져오기"""
-    results: List[Dict[str, Any]] = []
-    
-    for ticker in tickers:
-        result = fetch_ticker_price(ticker)
-        if result:
-            results.append(result)
-        
-        # 각 종목 사이에 작은 딜레이 (0.5~1초)
-        if ticker != tickers[-1]:  # 마지막 종목이 아니면
-            time.sleep(random.uniform(0.5, 1.0))
-    
-    return results
+
+            return {
+                "symbol": ticker_symbol,
+                "close": float(closes.iloc[-1]),
+                "trade_date": closes.index[-1].date().isoformat(),
+            }
+
+        except Exception as e:
+            if retry_count < MAX_RETRIES:
+                delay = INITIAL_RETRY_DELAY * (2 ** retry_count)  # Exponential backoff
+                print(f"Error fetching {ticker_symbol}: {e}. Retrying after {delay} seconds... (attempt {retry_count + 1}/{MAX_RETRIES})")
+                time.sleep(delay)
+            else:
+                print(f"✗ Failed to fetch {ticker_symbol} after {MAX_RETRIES} retries: {e}")
+
+    return None
 
 
 def fetch_all_quotes(tickers: List[str]) -> List[Dict[str, Any]]:
-    """모든 종목을 2~3개씩 랜덤하게 묶어서 순차적으로 가져오기"""
-    all_quotes: List[Dict[str, Any]] = []
-    i = 0
-    batch_num = 1
-    
-    while i < len(tickers):
-        # 랜덤하게 2~3개씩 묶기
-        batch_size = random.randint(MIN_BATCH_SIZE, MAX_BATCH_SIZE)
-        batch = tickers[i:i + batch_size]
-        
-        print(f"Fetching batch {batch_num}: {', '.join(batch)} ({len(batch)} tickers)")
-        quotes = fetch_quotes_batch(batch)
-        all_quotes.extend(quotes)
-        
-        i += batch_size
-        batch_num += 1
-        
-        # 마지막 배치가 아니면 랜덤 딜레이
-        if i < len(tickers):
-            delay = random.uniform(MIN_DELAY, MAX_DELAY)
-            print(f"Waiting {delay:.2f} seconds before next batch...")
-            time.sleep(delay)
-    
-    return all_quotes
+    """모든 종목의 최근 종가를 yf.download 한 번으로 가져오기"""
+    # 최근 5거래일 내 데이터 가져오기
+    # 주말/공휴일에도 마지막 거래일(예: 금요일) 데이터가 반환되므로
+    # trade_date를 "실제 거래일"로 잡아서 주말/공휴일 중복 저장을 방지한다.
+    df = yf.download(
+        tickers,
+        period="5d",
+        interval="1d",
+        group_by="ticker",
+        threads=MAX_DOWNLOAD_THREADS,
+        auto_adjust=True,
+        progress=False,
+    )
+
+    if df.empty:
+        # 일괄 다운로드 전체가 비었다면 대개 Yahoo 요청 제한이므로,
+        # 개별 fallback을 바로 쏟아내지 않고 한 번 쉬었다가 시작한다.
+        print(f"⚠ Warning: Batch download returned no data. Waiting {INITIAL_RETRY_DELAY} seconds before per-ticker fallback...")
+        time.sleep(INITIAL_RETRY_DELAY)
+
+    downloaded = set() if df.empty else set(df.columns.get_level_values(0))
+
+    quotes: List[Dict[str, Any]] = []
+    for ticker_symbol in tickers:
+        closes = df[ticker_symbol]["Close"].dropna() if ticker_symbol in downloaded else None
+        if closes is None or closes.empty:
+            # 일괄 다운로드에서 종가가 비어 있는 종목만 개별 history()로 재시도
+            print(f"· No close for {ticker_symbol} in batch download, retrying individually...")
+            quote = fetch_ticker_price(ticker_symbol)
+            if quote:
+                quotes.append(quote)
+            continue
+
+        quotes.append({
+            "symbol": ticker_symbol,
+            # 가장 최근 종가와 그 날짜(=마지막 거래일)를 사용
+            "close": float(closes.iloc[-1]),
+            "trade_date": closes.index[-1].date().isoformat(),
+        })
+
+    return quotes
 
 
 def build_rows(quotes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
@@ -136,103 +116,53 @@ def build_rows(quotes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     now = dt.datetime.now(dt.timezone.utc)
     fetched_at = now.isoformat().replace('+00:00', 'Z')
 
-    rows: List[Dict[str, Any]] = []
-    for quote in quotes:
-        symbol = quote.get("symbol")
-        close = quote.get("close")
-        trade_date = quote.get("trade_date")
-
-        if not symbol or close is None or not trade_date:
-            continue
-
-        rows.append({
-            "symbol": symbol,
+    # 필수 필드가 빠진 quote는 건너뛰고, 한 번의 순회로 행을 만든다.
+    # trade_date는 종목마다 마지막 거래일이 다를 수 있으므로 quote에서 그대로 가져온다.
+    return [
+        {
+            "symbol": sys.intern(symbol),
             "trade_date": trade_date,
             "close": float(close),
             "fetched_at": fetched_at,
-        })
-
-    return rows
+        }
+        for quote in quotes
+        if (symbol := quote.get("symbol"))
+        and (close := quote.get("close")) is not None
+        and (trade_date := quote.get("trade_date"))
+    ]
 
 
 def upsert_to_supabase(rows: List[Dict[str, Any]]) -> None:
-    supabase_url = os.environ.get("SUPABASE_URL")
-    service_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-
-    if not supabase_url or not service_key:
-        error_msg = "Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY in environment\n"
-        error_msg += "\n로컬 테스트 방법:\n"
-        error_msg += "1. PowerShell에서:\n"
-        error_msg += "   $env:SUPABASE_URL='your-url'\n"
-        error_msg += "   $env:SUPABASE_SERVICE_ROLE_KEY='your-key'\n"
-        error_msg += "   python scripts/fetch_stock_prices.py\n"
-        error_msg += "\n2. 또는 .env 파일에 추가:\n"
-        error_msg += "   SUPABASE_URL=your-url\n"
-        error_msg += "   SUPABASE_SERVICE_ROLE_KEY=your-key\n"
-        error_msg += "\n그리고: pip install python-dotenv\n"
-        raise RuntimeError(error_msg)
-
-    endpoint = f"{supabase_url.rstrip('/')}/rest/v1/stock_prices"
+    endpoint, headers, _ = stock_prices_config()
     params = {
         "on_conflict": "symbol,trade_date",
     }
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Content-Type": "application/json",
-        "Prefer": "resolution=merge-duplicates",
-    }
 
-    resp = requests.post(endpoint, params=params, headers=headers, data=json.dumps(rows), timeout=20)
+    resp = request_with_retry("POST", endpoint, params=params, headers=headers, content=orjson.dumps(rows), timeout=20)
     if resp.status_code >= 300:
         raise RuntimeError(f"Supabase upsert failed: {resp.status_code} {resp.text}")
 
 
 def cleanup_old_stock_prices() -> None:
     """300일 이상 된 stock_prices 데이터를 삭제"""
-    supabase_url = os.environ.get("SUPABASE_URL")
-    service_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-
-    if not supabase_url or not service_key:
-        # cleanup 함수에서는 더 간단한 에러 메시지
-        raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY in environment")
+    endpoint, _, headers = stock_prices_config()
 
     # 300일 전 날짜 계산
     cutoff_date = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=300)).date().isoformat()
     
-    endpoint = f"{supabase_url.rstrip('/')}/rest/v1/stock_prices"
     params = {
         "trade_date": f"lt.{cutoff_date}",  # trade_date < cutoff_date
     }
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Prefer": "return=representation",
-    }
 
-    # DELETE 요청 전에 삭제될 행 수 확인 (선택사항)
-    count_resp = requests.get(
-        endpoint,
-        params={**params, "select": "id"},
-        headers={**headers, "Range": "0-0"},
-        timeout=20
-    )
-    
-    if count_resp.status_code == 200:
-        # Content-Range 헤더에서 총 개수 추출
-        content_range = count_resp.headers.get("Content-Range", "")
-        if "/" in content_range:
-            total_count = content_range.split("/")[-1]
-            if total_count != "*" and total_count.isdigit():
-                print(f"Found {total_count} rows older than 300 days to delete")
-    
     # DELETE 요청 실행
-    resp = requests.delete(endpoint, params=params, headers=headers, timeout=20)
+    resp = request_with_retry("DELETE", endpoint, params=params, headers=headers, timeout=20)
     
     if resp.status_code >= 300:
         raise RuntimeError(f"Supabase delete failed: {resp.status_code} {resp.text}")
     
-    deleted_count = len(resp.json()) if resp.json() else 0
+    # Content-Range 헤더("*/N")에서 삭제된 행 수 추출
+    total_count = resp.headers.get("Content-Range", "").rpartition("/")[2]
+    deleted_count = total_count if total_count.isdigit() else "unknown number of"
     print(f"✓ Deleted {deleted_count} rows older than {cutoff_date} (300 days)")
 
 
@@ -240,8 +170,6 @@ def main() -> None:
     print("=" * 60)
     print("Starting stock price fetch using yfinance")
     print(f"Total tickers: {len(TICKERS)}")
-    print(f"Batch size: {MIN_BATCH_SIZE}~{MAX_BATCH_SIZE} (random)")
-    print(f"Delay between batches: {MIN_DELAY}~{MAX_DELAY}s (random)")
     print("=" * 60)
     
     try:
@@ -255,19 +183,24 @@ def main() -> None:
             print("⚠ No rows to insert. Exiting.")
             return
 
-        upsert_to_supabase(rows)
-        print(f"\n✓ Successfully upserted {len(rows)} rows to Supabase")
-        
-        # 300일 이상 된 데이터 정리
+        # upsert와 300일 이상 된 데이터 정리는 서로 독립적이므로
+        # 같은 HTTP/2 클라이언트 위에서 동시에 실행한다.
         print("\n" + "=" * 60)
-        print("Cleaning up old stock prices (older than 300 days)...")
+        print("Upserting rows and cleaning up old stock prices (older than 300 days)...")
         print("=" * 60)
-        try:
-            cleanup_old_stock_prices()
-        except Exception as cleanup_error:
-            # 정리 작업 실패해도 주가 업데이트는 성공했으므로 경고만 출력
-            print(f"⚠ Warning: Failed to cleanup old data: {cleanup_error}")
-            print("(This is non-critical - stock prices were still updated)")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            upsert_future = executor.submit(upsert_to_supabase, rows)
+            cleanup_future = executor.submit(cleanup_old_stock_prices)
+
+            try:
+                upsert_future.result()
+                print(f"✓ Successfully upserted {len(rows)} rows to Supabase")
+            finally:
+                # 정리 작업 실패는 upsert 성공 여부와 상관없이 항상 경고로만 출력
+                cleanup_error = cleanup_future.exception()
+                if cleanup_error is not None:
+                    print(f"⚠ Warning: Failed to cleanup old data: {cleanup_error}")
+                    print("(This is non-critical - cleanup does not affect the stock price upsert)")
         
         print("=" * 60)
         